@@ -36,11 +36,15 @@ Script to check for quota transgressions and notify the offending users.
 
 @author Andy Georges
 """
+import threading
+
+from multiprocessing.pool import ThreadPool
 
 from vsc.accountpage.client import AccountpageClient
 from vsc.config.base import VscStorage, GENT
 from vsc.filesystem.gpfs import GpfsOperations
-from vsc.filesystem.quota.tools import get_mmrepquota_maps, map_uids_to_names
+from vsc.filesystem.quota.tools import DJANGO_PUSH_BATCH_SIZE, QuotaException, cached_list_filesets, cached_uid_map
+from vsc.filesystem.quota.tools import filesets_for_quota, get_mmrepquota_maps, mail_exceeding_quota
 from vsc.filesystem.quota.tools import process_user_quota, process_fileset_quota
 from vsc.utils.script_tools import ExtendedSimpleOption
 
@@ -50,6 +54,147 @@ NAGIOS_CHECK_INTERVAL_THRESHOLD = 60 * 60  # one hour
 QUOTA_USERS_WARNING = 20
 QUOTA_USERS_CRITICAL = 40
 QUOTA_FILESETS_CRITICAL = 1
+STORAGE_ERROR_CRITICAL = 1
+
+BOOTSTRAP_THREADS = 2
+STORAGE_WORKERS = 2
+
+
+class QuotaMaps(object):
+    """
+    Hands out the mmrepquota maps of the storages to the storage workers.
+
+    mmrepquota runs once per filesystem and for one filesystem at a time. The maps of all storages on a
+    filesystem are built right away, so its raw quota data is dropped before the next filesystem is fetched.
+    The converted maps stay alive while their storage is pushed to the account page, so peak memory is the raw
+    data of one filesystem plus the maps of the storages being processed, which the number of storage workers
+    bounds. The GPFS calls are serialised, since GpfsOperations keeps its results in instance attributes.
+
+    The filesets may come from the cache, so they are listed again when the quota refers to unknown filesets.
+    """
+
+    def __init__(self, gpfs, storage_cfg, filesets, target_filesystems):
+        self.gpfs = gpfs
+        self.storage_cfg = storage_cfg
+        self.filesets = filesets
+        self.target_filesystems = target_filesystems
+
+        self.lock = threading.Lock()
+        self.quota_storage_maps = {}
+
+    def get(self, storage_name):
+        """
+        Get the quota maps for the storage.
+
+        Returns a tuple (quota storage map, filesets). The quota storage map is None if there is no
+        quota for the storage's filesystem.
+        """
+        with self.lock:
+            if storage_name not in self.quota_storage_maps:
+                self._fetch(self.storage_cfg[storage_name].filesystem)
+            return (self.quota_storage_maps.pop(storage_name), self.filesets)
+
+    def _fetch(self, filesystem):
+        """Run mmrepquota for the filesystem and build the maps of all storages on it."""
+        quota = self.gpfs.list_quota(devices=[filesystem])
+        if filesystem in quota:
+            self.filesets = filesets_for_quota(self.gpfs, self.filesets, filesystem, quota[filesystem],
+                                               devices=self.target_filesystems)
+
+        for (storage_name, cfg) in self.storage_cfg.items():
+            if cfg.filesystem != filesystem:
+                continue
+            if filesystem not in quota:
+                self.quota_storage_maps[storage_name] = None
+                continue
+            self.quota_storage_maps[storage_name] = get_mmrepquota_maps(
+                quota[filesystem],
+                storage_name,
+                filesystem,
+                self.filesets,
+                cfg.data_replication_factor,
+            )
+
+
+def _process_storage(logger, storage_name, storage, storage_cfg, gpfs, filesystems, quota_maps, user_id_map, client,
+                     dry_run=False, institute=GENT, batch_size=DJANGO_PUSH_BATCH_SIZE):
+    """
+    Process the quota for a single storage.
+
+    Returns a tuple (storage_name, exceeding filesets, exceeding users, stats). Raises a QuotaException
+    if the storage cannot be processed.
+    """
+    logger.info("Processing quota for storage_name %s" % (storage_name))
+    filesystem = storage_cfg[storage_name].filesystem
+
+    if filesystem not in filesystems:
+        raise QuotaException("Non-existent filesystem %s" % (filesystem))
+
+    (quota_storage_map, filesets) = quota_maps.get(storage_name)
+    if quota_storage_map is None:
+        raise QuotaException("No quota defined for storage_name %s [%s]" % (storage_name, filesystem))
+
+    # the fileset and user quota are pushed independently, so overlap their account page requests
+    pool = ThreadPool(processes=2)
+    try:
+        filesets_result = None
+        if quota_storage_map.get('FILESET'):
+            filesets_result = pool.apply_async(process_fileset_quota, (
+                storage, gpfs, storage_name, filesystem, quota_storage_map['FILESET'], client,
+            ), {'dry_run': dry_run, 'institute': institute, 'batch_size': batch_size, 'filesets': filesets})
+        else:
+            logger.debug("skipping fileset quota path for storage_name %s: no FILESET rows" % storage_name)
+
+        users_result = None
+        if quota_storage_map.get('USR'):
+            users_result = pool.apply_async(process_user_quota, (
+                storage, gpfs, storage_name, None, quota_storage_map['USR'], user_id_map, client,
+            ), {'dry_run': dry_run, 'institute': institute, 'batch_size': batch_size})
+        else:
+            logger.debug("skipping user quota path for storage_name %s: no USR rows" % storage_name)
+
+        exceeding_filesets = filesets_result.get() if filesets_result else []
+        exceeding_users = users_result.get() if users_result else []
+    finally:
+        pool.close()
+        pool.join()
+
+    stats = {
+        storage_name + "_fileset_critical": QUOTA_FILESETS_CRITICAL,
+        storage_name + "_fileset": 1 if exceeding_filesets else 0,
+        storage_name + "_users_warning": QUOTA_USERS_WARNING,
+        storage_name + "_users_critical": QUOTA_USERS_CRITICAL,
+        storage_name + "_users": len(exceeding_users),
+    }
+
+    if exceeding_filesets:
+        logger.warning("storage_name %s found %d filesets that are exceeding their quota:\n%s",
+                       storage_name, len(exceeding_filesets),
+                       "\n".join("  %s has quota %s" % e for e in exceeding_filesets))
+    else:
+        logger.debug("storage_name %s found no filesets that are exceeding their quota" % storage_name)
+
+    if exceeding_users:
+        logger.warning("storage_name %s found %d users who are exceeding their quota:\n%s",
+                       storage_name, len(exceeding_users),
+                       "\n".join("  %s has quota %s" % e for e in exceeding_users))
+    else:
+        logger.debug("storage_name %s found no users who are exceeding their quota" % storage_name)
+
+    return (storage_name, exceeding_filesets, exceeding_users, stats)
+
+
+def _process_storage_logged(logger, storage_name, *args):
+    """
+    Run _process_storage, logging a failure from within the worker thread.
+
+    The pool only hands the exception back to the main thread, and on Python 2 its traceback is lost there.
+    """
+    try:
+        return _process_storage(logger, storage_name, *args)
+    except Exception:
+        logger.exception("Failed processing quota for storage_name %s" % (storage_name))
+        raise
 
 
 def main():
@@ -62,82 +207,84 @@ def main():
         'account_page_url': ('Base URL of the account page', None, 'store', 'https://account.vscentrum.be/django'),
         'access_token': ('OAuth2 token to access the account page REST API', None, 'store', None),
         'host_institute': ('Name of the institute where this script is being run', str, 'store', GENT),
+        'account_page_batch_size': ('Number of quota entries pushed to the account page per request', int, 'store',
+                                    DJANGO_PUSH_BATCH_SIZE),
+        'refresh-uid-map': ('Ignore the cached uid to user name mapping', None, 'store_true', False),
+        'no-fileset-cache': ('Ignore the cached GPFS filesets', None, 'store_true', False),
+        'mail-admins': ('Mail a summary of the quota transgressions to the HPC admins', None, 'store_true', False),
+        'storage-workers': ('Number of storages processed concurrently; each one keeps its quota in memory',
+                            int, 'store', STORAGE_WORKERS),
     }
     opts = ExtendedSimpleOption(options)
     logger = opts.log
 
-    try:
-        client = AccountpageClient(token=opts.options.access_token)
+    dry_run = opts.options.dry_run
+    storages = opts.options.storage
+    access_token = opts.options.access_token
+    institute = opts.options.host_institute
+    batch_size = opts.options.account_page_batch_size
+
+    stats = {}
 
-        user_id_map = map_uids_to_names()  # is this really necessary?
+    try:
         gpfs = GpfsOperations()
         storage = VscStorage()
 
-        target_filesystems = [storage[s].filesystem for s in opts.options.storage]
+        storage_cfg = {s: storage[s] for s in storages}
+        target_filesystems = [c.filesystem for c in storage_cfg.values()]
 
-        filesystems = gpfs.list_filesystems(device=target_filesystems).keys()
-        logger.debug("Found the following GPFS filesystems: %s" % (filesystems))
-
-        filesets = gpfs.list_filesets(devices=target_filesystems)
-        logger.debug("Found the following GPFS filesets: %s" % (filesets))
-
-        quota = gpfs.list_quota(devices=target_filesystems)
         exceeding_filesets = {}
         exceeding_users = {}
-        stats = {}
 
-        for storage_name in opts.options.storage:
+        # the bootstrap steps are independent and mostly waiting on I/O, so run them concurrently
+        pool = ThreadPool(processes=BOOTSTRAP_THREADS)
+        try:
+            client_result = pool.apply_async(AccountpageClient, kwds={'token': access_token})
+            user_id_map_result = pool.apply_async(cached_uid_map, kwds={'refresh': opts.options.refresh_uid_map})
 
-            logger.info("Processing quota for storage_name %s" % (storage_name))
-            filesystem = storage[storage_name].filesystem
-            replication_factor = storage[storage_name].data_replication_factor
+            # GpfsOperations is not thread-safe, so its calls stay on this thread
+            filesystems = set(gpfs.list_filesystems(device=target_filesystems))
+            logger.debug("Found the following GPFS filesystems: %s" % (filesystems))
 
-            if filesystem not in filesystems:
-                logger.error("Non-existent filesystem %s" % (filesystem))
-                continue
+            filesets = cached_list_filesets(gpfs, devices=target_filesystems, refresh=opts.options.no_fileset_cache)
+            logger.debug("Found the following GPFS filesets: %s" % (filesets))
 
-            if filesystem not in quota.keys():
-                logger.error("No quota defined for storage_name %s [%s]" % (storage_name, filesystem))
-                continue
+            user_id_map = user_id_map_result.get()
+            client = client_result.get()
+        finally:
+            pool.close()
+            pool.join()
 
-            quota_storage_map = get_mmrepquota_maps(
-                quota[filesystem],
-                storage_name,
-                filesystem,
-                filesets,
-                replication_factor,
-            )
+        # the storages are mostly waiting on the account page, so process them concurrently, but limit the number
+        # in flight, since each one holds its quota maps until they are pushed
+        quota_maps = QuotaMaps(gpfs, storage_cfg, filesets, target_filesystems)
+        pool = ThreadPool(processes=max(1, min(opts.options.storage_workers, len(storages))))
+        try:
+            results = [
+                pool.apply_async(_process_storage_logged, (
+                    logger, storage_name, storage, storage_cfg, gpfs, filesystems, quota_maps, user_id_map, client,
+                    dry_run, institute, batch_size,
+                ))
+                for storage_name in storages
+            ]
+            for (storage_name, result) in zip(storages, results):
+                # a failing storage should not prevent reporting on the others
+                stats[storage_name + "_error_critical"] = STORAGE_ERROR_CRITICAL
+                try:
+                    (_, e_filesets, e_users, storage_stats) = result.get()
+                except Exception:
+                    stats[storage_name + "_error"] = 1  # the worker already logged the failure
+                    continue
+                stats[storage_name + "_error"] = 0
+                exceeding_filesets[storage_name] = e_filesets
+                exceeding_users[storage_name] = e_users
+                stats.update(storage_stats)
+        finally:
+            pool.close()
+            pool.join()
 
-            exceeding_filesets[storage_name] = process_fileset_quota(
-                storage, gpfs, storage_name, filesystem, quota_storage_map['FILESET'],
-                client, dry_run=opts.options.dry_run, institute=opts.options.host_institute)
-
-            exceeding_users[storage_name] = process_user_quota(
-                storage, gpfs, storage_name, None, quota_storage_map['USR'],
-                user_id_map, client, dry_run=opts.options.dry_run, institute=opts.options.host_institute)
-
-            stats["%s_fileset_critical" % (storage_name,)] = QUOTA_FILESETS_CRITICAL
-            if exceeding_filesets[storage_name]:
-                stats["%s_fileset" % (storage_name,)] = 1
-                logger.warning("storage_name %s found %d filesets that are exceeding their quota",
-                               storage_name, len(exceeding_filesets))
-                for (e_fileset, e_quota) in exceeding_filesets[storage_name]:
-                    logger.warning("%s has quota %s" % (e_fileset, str(e_quota)))
-            else:
-                stats["%s_fileset" % (storage_name,)] = 0
-                logger.debug("storage_name %s found no filesets that are exceeding their quota" % storage_name)
-
-            stats["%s_users_warning" % (storage_name,)] = QUOTA_USERS_WARNING
-            stats["%s_users_critical" % (storage_name,)] = QUOTA_USERS_CRITICAL
-            if exceeding_users[storage_name]:
-                stats["%s_users" % (storage_name,)] = len(exceeding_users[storage_name])
-                logger.warning("storage_name %s found %d users who are exceeding their quota" %
-                               (storage_name, len(exceeding_users[storage_name])))
-                for (e_user_id, e_quota) in exceeding_users[storage_name]:
-                    logger.warning("%s has quota %s" % (e_user_id, str(e_quota)))
-            else:
-                stats["%s_users" % (storage_name,)] = 0
-                logger.debug("storage_name %s found no users who are exceeding their quota" % storage_name)
+        if opts.options.mail_admins:
+            mail_exceeding_quota(exceeding_filesets, exceeding_users, dry_run=dry_run)
 
     except Exception as err:
         logger.exception("critical exception caught: %s" % (err))
@@ -77,7 +77,7 @@ def main():
                 filename = "gpfs_inodes_%s_%s.gz" % (time.strftime("%Y%m%d-%H:%M"), filesystem)
                 path = os.path.join(opts.options.location, filename)
                 zipfile = gzip.open(path, 'wb', 9)  # Compress to the max
-                zipfile.write(json.dumps(filesets[filesystem]))
+                zipfile.write(json.dumps(filesets[filesystem]).encode("utf-8"))
                 zipfile.close()
                 stats["%s_inodes_log" % (filesystem,)] = 0
                 logger.info("Stored inodes information for FS %s" % (filesystem))
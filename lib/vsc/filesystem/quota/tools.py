@@ -30,10 +30,15 @@ Helper functions for all things quota related.
 @author: Ward Poelmans (Vrije Universiteit Brussel)
 """
 
+import errno
+import gzip
 import logging
+import os
+import pickle
 import pwd
 import re
 import socket
+import tempfile
 import time
 
 from collections import namedtuple
@@ -51,6 +56,13 @@ GPFS_NOGRACE_REGEX = re.compile(r"none", re.I)
 QUOTA_USER_KIND = 'user'
 QUOTA_VO_KIND = 'vo'
 
+DJANGO_PUSH_BATCH_SIZE = 101
+
+UID_MAP_CACHE_PATH = '/var/cache/dquota/uid_map.pkl.gz'
+UID_MAP_CACHE_TTL = 60 * 60  # one hour
+FILESETS_CACHE_PATH = '/var/cache/dquota/filesets.pkl.gz'
+FILESETS_CACHE_TTL = 15 * 60  # 15 minutes
+
 
 class QuotaException(Exception):
     pass
@@ -70,16 +82,32 @@ Kind regards,
 Your friendly inode-watching script
 """
 
+EXCEEDING_QUOTA_MESSAGE = """
+Dear HPC admins,
+
+The following filesets and users are exceeding their quota.
+
+%(quota_info)s
+
+Kind regards,
+Your friendly quota-watching script
+"""
+
 
 class DjangoPusher(object):
-    """Context manager for pushing stuff to django"""
+    """
+    Context manager for pushing stuff to django
+
+    The payload for a storage is pushed once it holds batch_size entries, and on exit.
+    """
 
-    def __init__(self, storage_name, client, kind, dry_run):
+    def __init__(self, storage_name, client, kind, dry_run, batch_size=DJANGO_PUSH_BATCH_SIZE):
         self.storage_name = storage_name
         self.storage_name_shared = storage_name + STORAGE_SHARED_SUFFIX
         self.client = client
         self.kind = kind
         self.dry_run = dry_run
+        self.batch_size = batch_size
 
         self.count = {
             self.storage_name: 0,
@@ -114,7 +142,7 @@ class DjangoPusher(object):
         self.payload[storage_name].append(payload)
         self.count[storage_name] += 1
 
-        if self.count[storage_name] > 100:
+        if self.count[storage_name] >= self.batch_size:
             self._push(storage_name, self.payload[storage_name])
             self.count[storage_name] = 0
             self.payload[storage_name] = []
@@ -178,7 +206,7 @@ class DjangoPusher(object):
 
 
 def process_user_quota(storage, gpfs, storage_name, filesystem, quota_map, user_map, client,
-                       dry_run=False, institute=GENT):
+                       dry_run=False, institute=GENT, batch_size=DJANGO_PUSH_BATCH_SIZE):
     """
     Wrapper around the new function to keep the old behaviour intact.
     """
@@ -189,10 +217,13 @@ def process_user_quota(storage, gpfs, storage_name, filesystem, quota_map, user_
     path_template = storage.path_templates[institute][storage_name]
     vsc = VSC()
 
+    # users in the same grouping fileset share a pattern, so only compile it once
+    fileset_res = {}
+
     logging.info("Logging user quota to account page")
     logging.debug("Considering the following quota items for pushing: %s", quota_map)
 
-    with DjangoPusher(storage_name, client, QUOTA_USER_KIND, dry_run) as pusher:
+    with DjangoPusher(storage_name, client, QUOTA_USER_KIND, dry_run, batch_size=batch_size) as pusher:
         for (user_id, quota) in quota_map.items():
 
             user_institute = vsc.user_id_to_institute(int(user_id))
@@ -205,12 +236,15 @@ def process_user_quota(storage, gpfs, storage_name, filesystem, quota_map, user_
 
             fileset_name = path_template['user'](user_name)[1]
 
-            fileset_re = '^(vsc[1-4]|%s|%s|%s)' % (VO_PREFIX_BY_SITE[institute],
-                                                   VO_SHARED_PREFIX_BY_SITE[institute],
-                                                   fileset_name)
+            fileset_re = fileset_res.get(fileset_name)
+            if fileset_re is None:
+                fileset_re = re.compile('^(vsc[1-4]|%s|%s|%s)' % (VO_PREFIX_BY_SITE[institute],
+                                                                  VO_SHARED_PREFIX_BY_SITE[institute],
+                                                                  fileset_name))
+                fileset_res[fileset_name] = fileset_re
 
             for (fileset, quota_) in quota.quota_map.items():
-                if re.search(fileset_re, fileset):
+                if fileset_re.search(fileset):
                     pusher.push_quota(user_name, fileset, quota_)
 
             if quota.exceeds():
@@ -240,12 +274,15 @@ def get_mmrepquota_maps(quota_map, storage, filesystem, filesets,
 
     timestamp = int(time.time())
 
+    # resolve the fileset names once, rather than for each quota row
+    fileset_names = {fid: info['filesetName'] for (fid, info) in filesets.get(filesystem, {}).items()}
+
     logging.info("ordering USR quota for storage %s", storage)
     # Iterate over a list of named tuples -- GpfsQuota
     for (user, gpfs_quota) in quota_map['USR'].items():
         user_quota = user_map.get(user, QuotaUser(storage, filesystem, user))
         user_map[user] = _update_quota_entity(
-            filesets,
+            fileset_names,
             user_quota,
             filesystem,
             gpfs_quota,
@@ -258,7 +295,7 @@ def get_mmrepquota_maps(quota_map, storage, filesystem, filesets,
     for (fileset, gpfs_quota) in quota_map['FILESET'].items():
         fileset_quota = fs_map.get(fileset, QuotaFileset(storage, filesystem, fileset))
         fs_map[fileset] = _update_quota_entity(
-            filesets,
+            fileset_names,
             fileset_quota,
             filesystem,
             gpfs_quota,
@@ -298,11 +335,11 @@ def determine_grace_period(grace_string):
     return expired
 
 
-def _update_quota_entity(filesets, entity, filesystem, gpfs_quotas, timestamp, replication_factor=1):
+def _update_quota_entity(fileset_names, entity, filesystem, gpfs_quotas, timestamp, replication_factor=1):
     """
     Update the quota information for an entity (user or fileset).
 
-    @type filesets: string
+    @type fileset_names: dict with (fileset id, fileset name) key-value pairs for the filesystem
     @type entity: QuotaEntity instance
     @type filesystem: string
     @type gpfs_quota: list of GpfsQuota namedtuple instances
@@ -316,7 +353,7 @@ def _update_quota_entity(filesets, entity, filesystem, gpfs_quotas, timestamp, r
         files_expired = determine_grace_period(quota.filesGrace)
 
         if quota.filesetname:
-            fileset_name = filesets[filesystem][quota.filesetname]['filesetName']
+            fileset_name = fileset_names[quota.filesetname]
         else:
             fileset_name = None
 
@@ -342,16 +379,22 @@ def _update_quota_entity(filesets, entity, filesystem, gpfs_quotas, timestamp, r
     return entity
 
 
-def process_fileset_quota(storage, gpfs, storage_name, filesystem, quota_map, client, dry_run=False, institute=GENT):
-    """wrapper around the new function to keep the old behaviour intact"""
+def process_fileset_quota(storage, gpfs, storage_name, filesystem, quota_map, client, dry_run=False, institute=GENT,
+                          batch_size=DJANGO_PUSH_BATCH_SIZE, filesets=None):
+    """
+    wrapper around the new function to keep the old behaviour intact
+
+    If filesets is not given, they are obtained from gpfs.
+    """
     del storage
-    filesets = gpfs.list_filesets()
+    if filesets is None:
+        filesets = gpfs.list_filesets()
     exceeding_filesets = []
 
     logging.info("Logging VO quota to account page")
     logging.debug("Considering the following quota items for pushing: %s", quota_map)
 
-    with DjangoPusher(storage_name, client, QUOTA_VO_KIND, dry_run) as pusher:
+    with DjangoPusher(storage_name, client, QUOTA_VO_KIND, dry_run, batch_size=batch_size) as pusher:
         for (fileset, quota) in quota_map.items():
             fileset_name = filesets[filesystem][fileset]['filesetName']
             logging.debug("Fileset %s quota: %s", fileset_name, quota)
@@ -384,6 +427,115 @@ def map_uids_to_names():
     return d
 
 
+def _load_cache(path, ttl):
+    """
+    Load the pickled data from the gzipped cache file at path.
+
+    @returns: the cached data, or None if the cache is missing, older than ttl seconds or unreadable
+    """
+    if not os.path.exists(path):
+        logging.debug("No cache %s", path)
+        return None
+
+    try:
+        if time.time() - os.path.getmtime(path) >= ttl:
+            logging.debug("Cache %s has expired", path)
+            return None
+        with gzip.open(path, 'rb') as cache:
+            return pickle.load(cache)
+    except Exception as err:
+        # a corrupt cache can raise about anything while unzipping or unpickling, but it is never fatal
+        logging.warning("Cannot use cache %s: %s", path, err)
+        return None
+
+
+def _store_cache(path, data):
+    """
+    Atomically replace the gzipped cache file at path with the pickled data.
+
+    Failing to write the cache is not fatal, it is merely logged.
+    """
+    directory = os.path.dirname(path)
+    tmp_path = None
+    try:
+        try:
+            os.makedirs(directory, 0o755)
+        except OSError as err:
+            # another cache may be creating the same directory at the same time
+            if err.errno != errno.EEXIST:
+                raise
+        (fd, tmp_path) = tempfile.mkstemp(dir=directory)
+        os.close(fd)
+        with gzip.open(tmp_path, 'wb') as cache:
+            pickle.dump(data, cache, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as err:
+        logging.warning("Could not write cache %s: %s", path, err)
+        if tmp_path and os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+
+def cached_uid_map(path=UID_MAP_CACHE_PATH, ttl=UID_MAP_CACHE_TTL, refresh=False):
+    """
+    Cached version of map_uids_to_names.
+
+    The mapping is kept on disk at path and recomputed once it is older than ttl seconds, or when refresh is set.
+    """
+    user_id_map = None
+    if not refresh:
+        user_id_map = _load_cache(path, ttl)
+
+    if not isinstance(user_id_map, dict):
+        user_id_map = map_uids_to_names()
+        _store_cache(path, user_id_map)
+
+    return user_id_map
+
+
+def cached_list_filesets(gpfs, devices=None, path=FILESETS_CACHE_PATH, ttl=FILESETS_CACHE_TTL, refresh=False):
+    """
+    Cached version of gpfs.list_filesets.
+
+    The filesets are kept on disk at path, together with the devices they were listed for, and listed again once
+    the cache is older than ttl seconds, when it was made for other devices, or when refresh is set.
+    """
+    key = tuple(sorted(devices)) if devices else None
+
+    if not refresh:
+        cached = _load_cache(path, ttl)
+        if isinstance(cached, tuple) and len(cached) == 2 and cached[0] == key:
+            return cached[1]
+
+    filesets = gpfs.list_filesets(devices=devices)
+    _store_cache(path, (key, filesets))
+
+    return filesets
+
+
+def filesets_for_quota(gpfs, filesets, filesystem, quota_map, devices=None, path=FILESETS_CACHE_PATH):
+    """
+    Make sure the filesets know all filesets the quota_map of the filesystem refers to.
+
+    The filesets may come from the cache and miss filesets that were created since. If so, they are listed
+    again and the cache is rewritten.
+
+    @type quota_map: dict with the mmrepquota information of the filesystem, as returned by gpfs.list_quota
+    @returns: the filesets, listed again if needed
+    """
+    fileset_ids = set(quota_map.get('FILESET', {}))
+    for entities in quota_map.values():
+        for gpfs_quotas in entities.values():
+            fileset_ids.update(quota.filesetname for quota in gpfs_quotas if quota.filesetname)
+
+    missing = fileset_ids - set(filesets.get(filesystem, {}))
+    if not missing:
+        return filesets
+
+    logging.info("Unknown filesets %s in the quota of filesystem %s, listing the filesets again",
+                 sorted(missing), filesystem)
+    return cached_list_filesets(gpfs, devices=devices, path=path, refresh=True)
+
+
 def process_inodes_information(filesets, quota, threshold=0.9):
     """
     Determines which filesets have reached a critical inode limit.
@@ -433,3 +585,39 @@ def mail_admins(critical_filesets, dry_run=True):
                           reply_to="hpc-admin@lists.ugent.be",
                           mail_subject="Inode space(s) running out on %s" % (socket.gethostname()),
                           message=message)
+
+
+def mail_exceeding_quota(exceeding_filesets, exceeding_users, dry_run=True):
+    """
+    Send a single email to the HPC admins with the filesets and users exceeding their quota on all storages.
+
+    @type exceeding_filesets: dict with (storage_name, list of (fileset_name, quota)) key-value pairs
+    @type exceeding_users: dict with (storage_name, list of (user_name, quota)) key-value pairs
+    """
+    quota_info = []
+    for storage_name in sorted(set(exceeding_filesets) | set(exceeding_users)):
+        filesets = exceeding_filesets.get(storage_name) or []
+        users = exceeding_users.get(storage_name) or []
+        if not filesets and not users:
+            continue
+
+        quota_info.append("%s: %d filesets and %d users exceeding their quota" %
+                          (storage_name, len(filesets), len(users)))
+        quota_info.extend("  fileset %s has quota %s" % e for e in filesets)
+        quota_info.extend("  user %s has quota %s" % e for e in users)
+
+    if not quota_info:
+        logging.info("No filesets or users are exceeding their quota, not sending any mail")
+        return
+
+    message = EXCEEDING_QUOTA_MESSAGE % ({'quota_info': "\n".join(quota_info)})
+
+    if dry_run:
+        logging.info("Would have sent this message: %s", message)
+    else:
+        mail = VscMail(mail_host="smtp.ugent.be")
+        mail.sendTextMail(mail_to="hpc-admin@lists.ugent.be",
+                          mail_from="hpc-admin@lists.ugent.be",
+                          reply_to="hpc-admin@lists.ugent.be",
+                          mail_subject="Quota exceeded on %s" % (socket.gethostname()),
+                          message=message)
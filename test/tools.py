@@ -30,12 +30,17 @@ Tests for all helper functions in vsc.filesystems.quota.tools.
 @author: Ward Poelmans (Vrije Universiteit Brussel)
 """
 import os
+import shutil
+import tempfile
+import time
+
 import mock
 
 import vsc.filesystem.quota.tools as tools
 import vsc.config.base as config
 
 from vsc.config.base import VSC_DATA, GENT
+from vsc.filesystem.gpfs import GpfsQuota
 from vsc.filesystem.quota.entities import QuotaUser, QuotaFileset, QuotaInformation
 from vsc.filesystem.quota.tools import DjangoPusher, determine_grace_period, QUOTA_USER_KIND
 from vsc.install.testing import TestCase
@@ -48,6 +53,12 @@ class TestAuxiliary(TestCase):
     Stuff that does not belong anywhere else :)
     """
 
+    def setUp(self):
+        """Create a scratch directory for the caches"""
+        super(TestAuxiliary, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
     @mock.patch('vsc.filesystem.quota.tools.pwd.getpwall')
     def test_map_uids_to_names(self, mock_getpwall):
         """
@@ -60,6 +71,133 @@ class TestAuxiliary(TestCase):
 
         self.assertEqual(res, {3: 1, 6: 4, 9: 7})
 
+    @mock.patch('vsc.filesystem.quota.tools.map_uids_to_names')
+    def test_cached_uid_map(self, mock_map_uids_to_names):
+        """
+        Check that the uid map is only recomputed when the cache is stale or a refresh is requested
+        """
+        path = os.path.join(self.tmpdir, 'cache', 'uid_map.pkl.gz')
+
+        mock_map_uids_to_names.return_value = {2540075: 'vsc40075'}
+        self.assertEqual(tools.cached_uid_map(path=path), {2540075: 'vsc40075'})
+        self.assertTrue(os.path.exists(path))
+
+        mock_map_uids_to_names.return_value = {2510042: 'vsc10042'}
+        self.assertEqual(tools.cached_uid_map(path=path), {2540075: 'vsc40075'})
+        self.assertEqual(mock_map_uids_to_names.call_count, 1)
+
+        self.assertEqual(tools.cached_uid_map(path=path, refresh=True), {2510042: 'vsc10042'})
+        self.assertEqual(mock_map_uids_to_names.call_count, 2)
+
+        old = time.time() - 2 * tools.UID_MAP_CACHE_TTL
+        os.utime(path, (old, old))
+        mock_map_uids_to_names.return_value = {2540075: 'vsc40075'}
+        self.assertEqual(tools.cached_uid_map(path=path), {2540075: 'vsc40075'})
+        self.assertEqual(mock_map_uids_to_names.call_count, 3)
+
+    @mock.patch('vsc.filesystem.quota.tools.map_uids_to_names')
+    def test_cached_uid_map_corrupt(self, mock_map_uids_to_names):
+        """
+        Check that a corrupt cache is treated as a miss and gets replaced
+        """
+        path = os.path.join(self.tmpdir, 'uid_map.pkl.gz')
+
+        mock_map_uids_to_names.return_value = {2540075: 'vsc40075'}
+        tools.cached_uid_map(path=path)
+
+        # flip the bytes of the compressed data, leaving the gzip header intact
+        with open(path, 'rb') as cache:
+            data = bytearray(cache.read())
+        for idx in range(10, len(data) - 8):
+            data[idx] ^= 0xff
+        with open(path, 'wb') as cache:
+            cache.write(bytes(data))
+
+        self.assertEqual(tools.cached_uid_map(path=path), {2540075: 'vsc40075'})
+        self.assertEqual(mock_map_uids_to_names.call_count, 2)
+
+        # not gzipped at all
+        with open(path, 'wb') as cache:
+            cache.write(b'garbage')
+
+        self.assertEqual(tools.cached_uid_map(path=path), {2540075: 'vsc40075'})
+        self.assertEqual(mock_map_uids_to_names.call_count, 3)
+
+        # a valid pickle, but not of the expected shape
+        tools._store_cache(path, ['garbage'])
+        self.assertEqual(tools.cached_uid_map(path=path), {2540075: 'vsc40075'})
+        self.assertEqual(mock_map_uids_to_names.call_count, 4)
+
+    def test_cached_list_filesets(self):
+        """
+        Check that the filesets are only listed again when the cache is stale, unusable, for other devices or refreshed
+        """
+        path = os.path.join(self.tmpdir, 'filesets.pkl.gz')
+
+        gpfs = mock.MagicMock()
+        gpfs.list_filesets.return_value = {'kyukondata': {'0': {'filesetName': 'root'}}}
+
+        res = tools.cached_list_filesets(gpfs, devices=['kyukondata'], path=path)
+        self.assertEqual(res, {'kyukondata': {'0': {'filesetName': 'root'}}})
+
+        res = tools.cached_list_filesets(gpfs, devices=['kyukondata'], path=path)
+        self.assertEqual(res, {'kyukondata': {'0': {'filesetName': 'root'}}})
+        self.assertEqual(gpfs.list_filesets.call_count, 1)
+
+        tools.cached_list_filesets(gpfs, devices=['kyukonhome'], path=path)
+        gpfs.list_filesets.assert_called_with(devices=['kyukonhome'])
+        self.assertEqual(gpfs.list_filesets.call_count, 2)
+
+        tools.cached_list_filesets(gpfs, devices=['kyukonhome'], path=path, refresh=True)
+        self.assertEqual(gpfs.list_filesets.call_count, 3)
+
+        # a valid pickle, but not of the expected shape
+        tools._store_cache(path, ['garbage'])
+        res = tools.cached_list_filesets(gpfs, devices=['kyukonhome'], path=path)
+        self.assertEqual(res, {'kyukondata': {'0': {'filesetName': 'root'}}})
+        self.assertEqual(gpfs.list_filesets.call_count, 4)
+
+    def test_filesets_for_quota(self):
+        """
+        Check that the filesets are listed again when the quota refers to a fileset missing from the cache
+        """
+        path = os.path.join(self.tmpdir, 'filesets.pkl.gz')
+
+        filesystem = 'kyukondata'
+        cached_filesets = {filesystem: {'1': {'filesetName': 'vsc400'}}}
+        fresh_filesets = {filesystem: {'1': {'filesetName': 'vsc400'}, '2': {'filesetName': 'gvo00002'}}}
+
+        gpfs = mock.MagicMock()
+        gpfs.list_filesets.return_value = cached_filesets
+
+        usr_quota = mock.MagicMock(filesetname='1')
+        quota_map = {'USR': {'2540075': [usr_quota]}, 'FILESET': {'1': [usr_quota]}}
+
+        filesets = tools.cached_list_filesets(gpfs, devices=[filesystem], path=path)
+
+        res = tools.filesets_for_quota(gpfs, filesets, filesystem, quota_map, devices=[filesystem], path=path)
+        self.assertEqual(res, cached_filesets)
+        self.assertEqual(gpfs.list_filesets.call_count, 1)
+
+        # a fileset was created after the listing was cached
+        gpfs.list_filesets.return_value = fresh_filesets
+        quota_map['USR']['2540075'].append(mock.MagicMock(filesetname='2'))
+
+        res = tools.filesets_for_quota(gpfs, filesets, filesystem, quota_map, devices=[filesystem], path=path)
+        self.assertEqual(res, fresh_filesets)
+        self.assertEqual(gpfs.list_filesets.call_count, 2)
+        self.assertEqual(tools.cached_list_filesets(gpfs, devices=[filesystem], path=path), fresh_filesets)
+        self.assertEqual(gpfs.list_filesets.call_count, 2)
+
+        # the same holds for a FILESET entry
+        gpfs.list_filesets.return_value = cached_filesets
+        filesets = tools.cached_list_filesets(gpfs, devices=[filesystem], path=path, refresh=True)
+        gpfs.list_filesets.return_value = fresh_filesets
+
+        res = tools.filesets_for_quota(gpfs, filesets, filesystem, {'FILESET': {'2': []}},
+                                       devices=[filesystem], path=path)
+        self.assertEqual(res, fresh_filesets)
+
     def test_determine_grace_period(self):
         """
         Check the determine_grace_period function
@@ -70,6 +208,33 @@ class TestAuxiliary(TestCase):
         self.assertEqual(determine_grace_period("expired"), (True, 0))
         self.assertEqual(determine_grace_period("none"), (False, None))
 
+    @mock.patch('vsc.filesystem.quota.tools.VscMail')
+    def test_mail_exceeding_quota(self, mock_vscmail):
+        """
+        Check that a single mail is sent for all storages, and none if there is nothing to report
+        """
+        exceeding_filesets = {
+            'VSC_DATA': [('gvo00002', 'quota_gvo00002')],
+            'VSC_HOME': [],
+        }
+        exceeding_users = {
+            'VSC_DATA': [('vsc40075', 'quota_vsc40075')],
+            'VSC_HOME': [('vsc10042', 'quota_vsc10042')],
+        }
+
+        tools.mail_exceeding_quota(exceeding_filesets, exceeding_users, dry_run=False)
+
+        mock_vscmail.return_value.sendTextMail.assert_called_once()
+        message = mock_vscmail.return_value.sendTextMail.call_args[1]['message']
+        self.assertTrue("VSC_DATA: 1 filesets and 1 users exceeding their quota" in message)
+        self.assertTrue("  fileset gvo00002 has quota quota_gvo00002" in message)
+        self.assertTrue("  user vsc40075 has quota quota_vsc40075" in message)
+        self.assertTrue("VSC_HOME: 0 filesets and 1 users exceeding their quota" in message)
+
+        mock_vscmail.reset_mock()
+        tools.mail_exceeding_quota({'VSC_DATA': []}, {'VSC_DATA': []}, dry_run=False)
+        mock_vscmail.return_value.sendTextMail.assert_not_called()
+
 
 class TestProcessing(TestCase):
 
@@ -107,6 +272,47 @@ class TestProcessing(TestCase):
             any_order=True,
         )
 
+    @mock.patch.object(DjangoPusher, 'push_quota')
+    def test_process_user_quota_fileset_name(self, mock_django_pusher):
+        """
+        Check which filesets of a user get pushed, depending on the name of the user's own fileset
+        """
+        storage_name = VSC_DATA
+        item = 'vsc40075'
+        filesystem = 'kyukondata'
+        quota = QuotaUser(storage_name, filesystem, item)
+        for fileset in ['myfileset', 'otherfileset', 'gvo00002', 'vsc400']:
+            quota.update(fileset, used=1230, soft=456, hard=789, doubt=0, expired=(False, None), timestamp=None)
+
+        client = mock.MagicMock()
+        quota_map = {'2540075': quota}
+        user_map = {2540075: 'vsc40075'}
+
+        storage = mock.MagicMock()
+        storage.path_templates = {GENT: {storage_name: {'user': lambda user_name: ('/my_path', 'myfileset')}}}
+
+        tools.process_user_quota(
+            storage, None, storage_name, None, quota_map, user_map, client, dry_run=False, institute=GENT
+        )
+
+        self.assertEqual(
+            sorted(call[0][1] for call in mock_django_pusher.call_args_list),
+            ['gvo00002', 'myfileset', 'vsc400'],
+        )
+
+        # an empty fileset name matches all filesets
+        mock_django_pusher.reset_mock()
+        storage.path_templates = {GENT: {storage_name: {'user': lambda user_name: ('/my_path', '')}}}
+
+        tools.process_user_quota(
+            storage, None, storage_name, None, quota_map, user_map, client, dry_run=False, institute=GENT
+        )
+
+        self.assertEqual(
+            sorted(call[0][1] for call in mock_django_pusher.call_args_list),
+            ['gvo00002', 'myfileset', 'otherfileset', 'vsc400'],
+        )
+
     @mock.patch.object(DjangoPusher, 'push_quota')
     def test_process_fileset_quota_no_store(self, mock_django_pusher):
 
@@ -139,6 +345,85 @@ class TestProcessing(TestCase):
 
         mock_django_pusher.assert_called_once_with('gvo00002', 'gvo00002', quota.quota_map['gvo00002'], shared=False)
 
+    def test_get_mmrepquota_maps(self):
+
+        storage_name = VSC_DATA
+        filesystem = 'kyukondata'
+
+        filesets = {
+            filesystem: {
+                '1': {'filesetName': 'vsc400'},
+                '2': {'filesetName': 'gvo00002'},
+            }
+        }
+
+        gpfs_quota = GpfsQuota(
+            name='2540075',
+            blockUsage=2460,
+            blockQuota=912,
+            blockLimit=1578,
+            blockInDoubt=0,
+            blockGrace='none',
+            filesUsage=10,
+            filesQuota=20,
+            filesLimit=30,
+            filesInDoubt=0,
+            filesGrace='none',
+            remarks='',
+            quota='on',
+            defQuota='off',
+            fid='1',
+            filesetname='1',
+        )
+
+        quota_map = {
+            'USR': {
+                '2540075': [gpfs_quota, gpfs_quota._replace(fid='2', filesetname='2')],
+            },
+            'FILESET': {
+                '2': [gpfs_quota._replace(name='2', fid='2', filesetname='2')],
+            },
+        }
+
+        res = tools.get_mmrepquota_maps(quota_map, storage_name, filesystem, filesets, replication_factor=2)
+
+        self.assertEqual(sorted(res['USR']['2540075'].quota_map.keys()), ['gvo00002', 'vsc400'])
+        self.assertEqual(res['USR']['2540075'].quota_map['vsc400'].used, 1230)
+        self.assertEqual(list(res['FILESET']['2'].quota_map.keys()), ['gvo00002'])
+
+    @mock.patch.object(DjangoPusher, 'push_quota')
+    def test_process_fileset_quota_filesets(self, mock_django_pusher):
+
+        storage_name = VSC_DATA
+        filesystem = 'vulpixdata'
+        fileset = 'gvo00002'
+        quota = QuotaFileset(storage_name, filesystem, fileset)
+        quota.update('gvo00002', used=1230, soft=456, hard=789, doubt=0, expired=(False, None), timestamp=None)
+
+        storage = mock.MagicMock()
+
+        filesets = {
+            filesystem: {
+                fileset: {
+                    'path': '/my_path',
+                    'filesetName': fileset,
+                }
+            }
+        }
+        gpfs = mock.MagicMock()
+
+        client = mock.MagicMock()
+
+        quota_map = {fileset: quota}
+
+        tools.process_fileset_quota(
+            storage, gpfs, storage_name, filesystem, quota_map, client, dry_run=False, institute=GENT,
+            filesets=filesets,
+        )
+
+        gpfs.list_filesets.assert_not_called()
+        mock_django_pusher.assert_called_once_with('gvo00002', 'gvo00002', quota.quota_map['gvo00002'], shared=False)
+
     def test_django_pusher(self):
 
         client = mock.MagicMock()
@@ -149,6 +434,28 @@ class TestProcessing(TestCase):
 
             self.assertEqual(pusher.payload, {"my_storage": [], "my_storage_SHARED": []})
 
+    def test_django_pusher_batch_size(self):
+
+        client = mock.MagicMock()
+
+        with DjangoPusher("my_storage", client, QUOTA_USER_KIND, False, batch_size=10) as pusher:
+            for i in range(0, 9):
+                pusher.push("my_storage", "pushing %d" % i)
+
+            self.assertEqual(len(pusher.payload["my_storage"]), 9)
+            client.usage.storage["my_storage"].user.size.put.assert_not_called()
+
+            pusher.push("my_storage", "pushing 9")
+            self.assertEqual(pusher.payload, {"my_storage": [], "my_storage_SHARED": []})
+            client.usage.storage["my_storage"].user.size.put.assert_called_once_with(
+                body=["pushing %d" % i for i in range(0, 10)]
+            )
+
+            pusher.push("my_storage", "pushing 10")
+            self.assertEqual(pusher.payload["my_storage"], ["pushing 10"])
+
+        client.usage.storage["my_storage"].user.size.put.assert_called_with(body=["pushing 10"])
+
     def test_django_push_quota(self):
 
         client = mock.MagicMock()